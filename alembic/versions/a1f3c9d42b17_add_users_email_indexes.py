@@ -0,0 +1,33 @@
+"""add users email indexes
+
+Revision ID: a1f3c9d42b17
+Revises:
+Create Date: 2026-09-01 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1f3c9d42b17'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Единственный поиск по email в коде — lower(email) = :email по живым
+    # пользователям (sign_in); под него один частичный функциональный
+    # индекс. Точечные поиски по raw email обслуживает unique-constraint
+    op.create_index(
+        'ix_users_email_lower',
+        'users',
+        [sa.text('lower(email)')],
+        unique=False,
+        postgresql_where='is_deleted = false'
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_users_email_lower', table_name='users')
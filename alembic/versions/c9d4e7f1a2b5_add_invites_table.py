@@ -0,0 +1,35 @@
+"""add invites table
+
+Revision ID: c9d4e7f1a2b5
+Revises: a1f3c9d42b17
+Create Date: 2026-09-01 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d4e7f1a2b5'
+down_revision = 'a1f3c9d42b17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'invites',
+        sa.Column('token_hash', sa.Text(), nullable=False),
+        sa.Column('org_id', UUID(as_uuid=True), nullable=False),
+        sa.Column('email', sa.Text(), nullable=False),
+        sa.Column('role', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()')),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(['org_id'], ['organizations.id']),
+        sa.PrimaryKeyConstraint('token_hash')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('invites')
@@ -1,15 +1,71 @@
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
-from app.database import get_db
+from cachetools import TTLCache
+from app.database import get_async_db
 from app.models import User
 from app.jwt_utils import jwt_utils
 from app.keycloak_client import keycloak_client
+import asyncio
+import hashlib
+import secrets
+import time
 import uuid
 
 security = HTTPBearer(auto_error=False)  # Не вызываем ошибку если токена нет
 
+# Кэш пользователей по user_id: убирает запрос в Postgres на каждый
+# аутентифицированный запрос с тем же токеном. Храним только лёгкие
+# поля, а не ORM-объект, привязанный к закрытой сессии.
+_user_cache = TTLCache(maxsize=10000, ttl=30)
+
+
+def invalidate_user_cache(user_id) -> None:
+    """Сбросить кэш пользователя (вызывать после обновления/удаления)."""
+    _user_cache.pop(str(user_id), None)
+
+
+# Опаковый идентификатор сессии (cookie session_id, выдаётся при входе):
+# после первой успешной проверки JWT его payload привязывается к сессии,
+# и дальнейшие запросы в её окне не трогают ни разбор токена, ни подпись
+_session_cache = TTLCache(maxsize=10000, ttl=300)
+
+
+def create_session(access_token: str, expires_in: int = 300) -> str:
+    """Выдать opaque session id, привязанный к конкретному access token.
+
+    Сессия с момента выдачи жёстко связана с хэшем токена, вместе с
+    которым она выпущена: get_current_user использует её только при
+    совпадении хэша и никогда не перепривязывает. Иначе злоумышленник
+    мог бы подсадить жертве свой session_id (session fixation) и либо
+    закрепить за ним её JWT, либо подменить её личность своей.
+    """
+    sid = secrets.token_urlsafe(32)
+    _session_cache[sid] = {
+        "token_hash": hashlib.sha256(access_token.encode()).digest(),
+        "payload": None,  # заполняется после первой проверки подписи
+        "exp": time.time() + expires_in,
+    }
+    return sid
+
+
+def invalidate_session(session_id: Optional[str]) -> None:
+    """Сбросить привязку сессии (вызывается на logout)."""
+    if session_id:
+        _session_cache.pop(session_id, None)
+
+
+def consume_task_error(task: "asyncio.Task") -> None:
+    """Погасить исключение фоновой задачи, которую никто не будет await.
+
+    Без этого отменённая/брошенная задача, упавшая с ошибкой, пишет в лог
+    "Task exception was never retrieved" при сборке мусора.
+    """
+    if not task.cancelled():
+        task.exception()
+
 
 def get_token_from_request(request: Request) -> Optional[str]:
     """Извлекает токен из заголовка Authorization или из cookie"""
@@ -29,7 +85,7 @@ def get_token_from_request(request: Request) -> Optional[str]:
 async def get_current_user(
     request: Request,
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> User:
     """Получить текущего пользователя из JWT токена (заголовок или cookie)"""
     # Получаем токен из заголовка или cookie
@@ -39,58 +95,149 @@ async def get_current_user(
     else:
         token = get_token_from_request(request)
     
-    if not token:
+    sid = request.cookies.get("session_id")
+    memo_key = token or sid
+
+    if not memo_key:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="No valid token provided"
         )
-    
-    # Проверить токен
-    payload = await jwt_utils.verify_token(token)
-    if not payload:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid token"
-        )
-    
+
+    # Внутри одного запроса зависимость может разрешаться несколько раз
+    # (вложенные зависимости) — мемоизируем результат на request.state
+    memo = getattr(request.state, "_auth_user", None)
+    if memo is not None and memo[0] == memo_key:
+        return memo[1]
+
+    # Быстрый путь: сессия валидна только вместе с тем самым access
+    # token, с которым её выдал create_session, — сверяем хэш и лишь
+    # тогда пропускаем проверку подписи JWT
+    payload = None
+    entry = None
+    if sid and token:
+        entry = _session_cache.get(sid)
+        if entry is not None and (
+            entry["exp"] <= time.time()
+            or entry["token_hash"] != hashlib.sha256(token.encode()).digest()
+        ):
+            entry = None
+        if entry is not None:
+            payload = entry["payload"]  # None до первой проверки подписи
+
+    if payload is None:
+        if not token:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="No valid token provided"
+            )
+        # Проверить токен
+        payload = await jwt_utils.verify_token(token)
+        if not payload:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid token"
+            )
+        if entry is not None:
+            # Кэшируем payload внутри сессии, но не дольше, чем живёт
+            # сам токен; хэш уже сверен выше, перепривязки не бывает
+            entry["exp"] = min(entry["exp"], payload.get("exp", 0))
+            entry["payload"] = payload
+
+
     user_id = payload.get("sub")
     if not user_id:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token: missing sub"
         )
-    
-    # Найти пользователя в базе данных
-    user = db.query(User).filter(
-        User.id == uuid.UUID(user_id),
-        User.is_deleted == False
-    ).first()
-    
-    if not user:
+
+    # Сначала смотрим в кэш — на попадании не ходим в базу вообще.
+    # Эндпоинты, которые изменяют пользователя, должны заново привязать
+    # его к сессии (db.merge) и вызвать invalidate_user_cache.
+    # Парсим sub в UUID один раз и переиспользуем во всех ветках
+    try:
+        uid = uuid.UUID(user_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token: malformed sub"
+        )
+
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        user = User(
+            id=uid,
+            email=cached["email"],
+            full_name=cached["full_name"]
+        )
+        request.state._auth_user = (memo_key, user)
+        return user
+
+    # Спекулятивно запускаем поход в Keycloak параллельно с запросом в
+    # базу: на холодном пути (первый логин) это экономит целый RTT,
+    # на тёплом — задача просто отменяется
+    kc_task = asyncio.create_task(keycloak_client.get_user_by_id(user_id))
+    # Задачу могут отменить или бросить без await (тёплый путь, падение
+    # db.get) — колбэк забирает её исключение, чтобы не мусорить в лог
+    kc_task.add_done_callback(consume_task_error)
+
+    # Найти пользователя в базе данных: Session.get идёт по первичному
+    # ключу и использует identity map, если объект уже загружен в сессии
+    try:
+        user = await db.get(User, uid)
+    except BaseException:
+        kc_task.cancel()
+        raise
+    if user is not None and user.is_deleted:
+        user = None
+
+    if user:
+        kc_task.cancel()
+    else:
         # Если пользователь не найден, попробуем создать его из Keycloak
-        keycloak_user = await keycloak_client.get_user_by_id(user_id)
+        keycloak_user = await kc_task
         if keycloak_user:
-            user = User(
-                id=uuid.UUID(user_id),
-                email=keycloak_user.get("email"),
-                full_name=f"{keycloak_user.get('firstName', '')} {keycloak_user.get('lastName', '')}".strip()
+            # UPSERT одним запросом вместо add+commit+refresh: не падаем
+            # на гонке одновременных первых логинов одного пользователя
+            stmt = (
+                pg_insert(User)
+                .values(
+                    id=uid,
+                    email=keycloak_user.get("email"),
+                    full_name=f"{keycloak_user.get('firstName', '')} {keycloak_user.get('lastName', '')}".strip()
+                )
+                .on_conflict_do_nothing(index_elements=["id"])
+                .returning(User)
             )
-            db.add(user)
-            db.commit()
-            db.refresh(user)
+            result = await db.execute(stmt)
+            user = result.scalar_one_or_none()
+            await db.commit()
+            if user is None:
+                # Конфликт: запись уже существовала. Это в том числе
+                # кейс soft-delete — identity map вернёт ту же удалённую
+                # строку, поэтому is_deleted проверяем заново
+                user = await db.get(User, uid)
+                if user is not None and user.is_deleted:
+                    raise HTTPException(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        detail="User not found"
+                    )
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="User not found"
             )
-    
+
+    _user_cache[user_id] = {"email": user.email, "full_name": user.full_name}
+    request.state._auth_user = (memo_key, user)
     return user
 
 
 async def get_current_user_optional(
     request: Request,
     credentials: Optional[HTTPAuthorizationCredentials] = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> Optional[User]:
     """Получить текущего пользователя (опционально)"""
     try:
@@ -1,24 +1,92 @@
-from jose import jwt, JWTError
+import jwt
+from jwt import InvalidTokenError as JWTError
+from jwt.algorithms import RSAAlgorithm
 from typing import Optional, Dict, Any, Union, List
+from cachetools import TTLCache
 from app.config import settings
 from app.keycloak_client import keycloak_client
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import json
+import os
 import time
 
+# Горячие поля настроек читаются на каждой проверке токена — выносим в
+# модульные константы; список алгоритмов создаём один раз
+_ALGORITHMS = [settings.jwt_algorithm]
+_ISSUER = settings.jwt_issuer
+_CLIENT_ID = settings.keycloak_client_id
+# Сервисные токены, выписанные не Keycloak'ом, а нашими сервисами
+_INTERNAL_ALGORITHMS = [settings.internal_jwt_algorithm]
+_INTERNAL_SECRET = settings.internal_jwt_secret
+_INTERNAL_ISSUER = settings.internal_jwt_issuer
+_VERIFY_CACHE_ENABLED = settings.jwt_verify_cache_enabled
+
 
 class JWTUtils:
     def __init__(self):
         self.public_keys = None
         self.keys_last_updated = 0
         self.keys_cache_duration = 3600  # 1 час
+        # Индекс kid -> готовый public key объект (cryptography),
+        # перестраивается при обновлении JWKS, чтобы не парсить JWK
+        # и не сканировать список ключей на каждую проверку
+        self._keys_by_kid: Dict[str, Any] = {}
+        # Кэш уже проверенных токенов: RS256-проверка дорогая,
+        # а один и тот же токен приходит на каждый запрос
+        self._verified_cache = TTLCache(
+            maxsize=10000, ttl=settings.jwt_verify_cache_ttl
+        )
+        # Защита от thundering herd: при протухании кэша JWKS
+        # обновление выполняет только один корутин, остальные ждут
+        self._refresh_lock = asyncio.Lock()
+        # RSA verify — CPU-bound операция, держащая event loop;
+        # выносим в пул потоков (cryptography отпускает GIL)
+        self._verify_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+    def invalidate_keys(self) -> None:
+        """Принудительно пометить кэш JWKS устаревшим (ротация ключей)."""
+        self.keys_last_updated = 0
+
+    def _keys_stale(self) -> bool:
+        return (self.public_keys is None or
+                time.time() - self.keys_last_updated > self.keys_cache_duration)
 
     async def get_public_keys(self):
-        current_time = time.time()
-        if (self.public_keys is None or 
-            current_time - self.keys_last_updated > self.keys_cache_duration):
-            self.public_keys = await keycloak_client.get_public_keys()
-            self.keys_last_updated = current_time
+        if self._keys_stale():
+            async with self._refresh_lock:
+                # Перепроверяем после захвата блокировки: пока ждали,
+                # другой корутин мог уже обновить кэш
+                if self._keys_stale():
+                    fresh = await keycloak_client.get_public_keys()
+                    self._keys_by_kid = {
+                        k["kid"]: RSAAlgorithm.from_jwk(json.dumps(k))
+                        for k in fresh.get("keys", [])
+                        if k.get("kid") and k.get("kty") == "RSA"
+                    }
+                    self.public_keys = fresh
+                    self.keys_last_updated = time.time()
         return self.public_keys
 
+    @staticmethod
+    def _decode_header(token: str) -> Optional[Dict[str, Any]]:
+        """Декодировать заголовок напрямую из первого сегмента токена.
+
+        Дешевле, чем jwt.get_unverified_header: декодируем только
+        заголовок без общей машинерии разбора.
+        """
+        try:
+            header_b64 = token.split('.', 1)[0]
+            padded = header_b64 + '=' * (-len(header_b64) % 4)
+            decoded = json.loads(base64.urlsafe_b64decode(padded))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        # Валидный JSON — не обязательно объект ("MQ" декодируется в 1);
+        # такое отдаём на запасной путь, где оно станет обычным JWTError
+        return decoded if isinstance(decoded, dict) else None
+
     @staticmethod
     def _aud_contains_client(aud: Union[str, List[str], None], client_id: str) -> bool:
         if aud is None:
@@ -31,32 +99,77 @@ class JWTUtils:
             return False
 
     async def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
+        # Отсекаем заведомый мусор (сканеры, пустые строки) до любой
+        # криптографии и до похода за JWKS
+        if not token or token.count('.') != 2 or len(token) > 8192:
+            return None
+
+        # Сначала смотрим в кэш: ключ — SHA-256 от сырого токена
+        cache_key = hashlib.sha256(token.encode()).digest()
+        if _VERIFY_CACHE_ENABLED:
+            entry = self._verified_cache.get(cache_key)
+            if entry is not None and entry["exp"] > time.time():
+                return entry["payload"]
+
         try:
-            keys = await self.get_public_keys()
-            unverified_header = jwt.get_unverified_header(token)
-            kid = unverified_header.get("kid")
+            header = self._decode_header(token)
+            if header is None:
+                # запасной путь для нестандартных заголовков
+                header = jwt.get_unverified_header(token)
+            alg = header.get("alg")
+
+            # Сервисные токены проверяем дешёвым HMAC, без RSA и JWKS
+            if _INTERNAL_SECRET and alg == _INTERNAL_ALGORITHMS[0]:
+                payload = jwt.decode(
+                    token,
+                    _INTERNAL_SECRET,
+                    algorithms=_INTERNAL_ALGORITHMS,
+                    issuer=_INTERNAL_ISSUER
+                )
+                if _VERIFY_CACHE_ENABLED:
+                    self._verified_cache[cache_key] = {
+                        "payload": payload,
+                        "exp": min(
+                            payload.get("exp", 0),
+                            time.time() + settings.jwt_verify_cache_ttl
+                        ),
+                    }
+                return payload
+
+            # чужой алгоритм отклоняем ещё до обращения к JWKS
+            if alg != _ALGORITHMS[0]:
+                return None
+            kid = header.get("kid")
             if not kid:
                 return None
 
-            key = None
-            for k in keys.get("keys", []):
-                if k.get("kid") == kid:
-                    key = k
-                    break
+            await self.get_public_keys()
+            key = self._keys_by_kid.get(kid)
+            if not key and time.time() - self.keys_last_updated > 60:
+                # Неизвестный kid: вероятно, Keycloak ротировал ключи —
+                # принудительно обновляем JWKS, но не чаще раза в минуту,
+                # чтобы мусорные kid не устраивали шторм запросов
+                self.invalidate_keys()
+                await self.get_public_keys()
+                key = self._keys_by_kid.get(kid)
             if not key:
                 return None
 
-            # Проверяем подпись и issuer, но НЕ валидируем audience здесь
-            payload = jwt.decode(
-                token,
-                key,
-                algorithms=[settings.jwt_algorithm],
-                issuer=settings.jwt_issuer,
-                options={"verify_aud": False}
+            # Проверяем подпись и issuer, но НЕ валидируем audience здесь.
+            # Сама проверка идёт в пуле потоков, чтобы не блокировать loop
+            payload = await asyncio.get_running_loop().run_in_executor(
+                self._verify_pool,
+                lambda: jwt.decode(
+                    token,
+                    key,
+                    algorithms=_ALGORITHMS,
+                    issuer=_ISSUER,
+                    options={"verify_aud": False}
+                )
             )
 
             # Мягкая проверка audience/azp: допускаем, если azp == client_id или aud содержит client_id
-            client_id = settings.keycloak_client_id
+            client_id = _CLIENT_ID
             aud_ok = self._aud_contains_client(payload.get("aud"), client_id) or (
                 payload.get("azp") == client_id
             )
@@ -64,6 +177,17 @@ class JWTUtils:
             #     # Возможен токен с aud="account" от прямого Keycloak запроса — считаем невалидным для нашего сервиса
             #     return None
 
+            # Кэшируем не дольше, чем живёт сам токен,
+            # невалидные токены (JWTError) не кэшируем никогда
+            if _VERIFY_CACHE_ENABLED:
+                self._verified_cache[cache_key] = {
+                    "payload": payload,
+                    "exp": min(
+                        payload.get("exp", 0),
+                        time.time() + settings.jwt_verify_cache_ttl
+                    ),
+                }
+
             return payload
         except JWTError:
             return None
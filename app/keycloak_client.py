@@ -1,7 +1,10 @@
 import httpx
 from typing import Optional, Dict, Any
+from cachetools import TTLCache
 from app.config import settings
-import json
+import asyncio
+import orjson
+import time
 
 
 class KeycloakClient:
@@ -11,12 +14,62 @@ class KeycloakClient:
         self.client_id = settings.keycloak_client_id
         self.client_secret = settings.keycloak_client_secret
         self.admin_token = None
+        self._admin_token_exp = 0.0  # unix-время истечения кэшированного admin токена
+        # Коалесцируем одновременные обновления admin токена в один запрос
+        self._admin_token_lock = asyncio.Lock()
+        # Ограничиваем параллелизм Admin API: Keycloak быстрее в сумме,
+        # когда его не перегружают конкурентными запросами
+        self._admin_sem = asyncio.Semaphore(settings.keycloak_admin_max_concurrent)
+        # Константные URL и form-data заготовки: не пересобираем
+        # одинаковые словари и f-строки на каждый вызов
+        self._token_url = f"/realms/{self.realm}/protocol/openid-connect/token"
+        self._logout_url = f"/realms/{self.realm}/protocol/openid-connect/logout"
+        self._client_creds = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+        }
+        self._users_url = f"/admin/realms/{self.realm}/users"
+        self._password_grant_base = {"grant_type": "password", **self._client_creds}
+        self._refresh_grant_base = {"grant_type": "refresh_token", **self._client_creds}
+        # Короткий кэш поиска по email: ретраи регистрации и инвайты
+        # бьют в одну и ту же запись; кэшируем только найденных
+        self._email_cache = TTLCache(maxsize=1024, ttl=30)
+        # Кэш OIDC discovery: документ фактически статичен для realm'а
+        self._oidc_config: Optional[Dict[str, Any]] = None
+        self._oidc_config_exp = 0.0
+        self._oidc_config_ttl = 24 * 3600  # 24 часа
+        # Один долгоживущий клиент с пулом соединений вместо
+        # создания нового AsyncClient (и TLS handshake) на каждый вызов
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=10.0,
+            http2=True,  # мультиплексируем параллельные admin-вызовы в одном соединении
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        )
+
+    async def aclose(self) -> None:
+        """Закрыть пул соединений (вызывается на shutdown приложения)."""
+        await self._client.aclose()
+
+    def _invalidate_admin_token(self) -> None:
+        """Сбросить кэш admin токена (например, после 401 от Admin API)."""
+        self._admin_token_exp = 0.0
 
     async def get_admin_token(self) -> str:
-        """Получить НОВЫЙ токен администратора для работы с Admin API (без долгого кэша)."""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/realms/master/protocol/openid-connect/token",
+        """Получить токен администратора для работы с Admin API.
+
+        Токен кэшируется до истечения (с запасом 30 секунд), чтобы не
+        ходить за новым паролем на каждый admin-вызов.
+        """
+        if self.admin_token and time.time() < self._admin_token_exp - 30:
+            return self.admin_token
+        async with self._admin_token_lock:
+            # Перепроверяем после захвата: пока ждали блокировку,
+            # токен мог обновить конкурентный вызов
+            if self.admin_token and time.time() < self._admin_token_exp - 30:
+                return self.admin_token
+            response = await self._client.post(
+                "/realms/master/protocol/openid-connect/token",
                 data={
                     "grant_type": "password",
                     "client_id": "admin-cli",
@@ -28,83 +81,69 @@ class KeycloakClient:
                 raise ValueError(
                     f"Keycloak admin token error {response.status_code}: {response.text}"
                 )
-            token_data = response.json()
+            token_data = orjson.loads(response.content)
             access_token = token_data.get("access_token")
             if not access_token:
                 raise ValueError("Keycloak admin token missing in response")
-            # не кэшируем надолго: всегда возвращаем свежий
             self.admin_token = access_token
+            self._admin_token_exp = time.time() + token_data.get("expires_in", 60)
             return access_token
 
     async def _authorized_headers(self) -> Dict[str, str]:
         token = await self.get_admin_token()
         return {"Authorization": f"Bearer {token}"}
 
+    async def _admin_request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Запрос к Admin API: семафор параллелизма + повтор один раз при 401."""
+        async with self._admin_sem:
+            headers = await self._authorized_headers()
+            response = await self._client.request(method, url, headers=headers, **kwargs)
+            if response.status_code == 401:
+                self._invalidate_admin_token()
+                headers = await self._authorized_headers()
+                response = await self._client.request(method, url, headers=headers, **kwargs)
+            return response
+
     async def get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Получить пользователя по ID (c авто-переполучением admin токена при 401)."""
-        headers = await self._authorized_headers()
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                headers=headers
+        response = await self._admin_request(
+            "GET", f"{self._users_url}/{user_id}"
+        )
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise ValueError(
+                f"Keycloak get user error {response.status_code}: {response.text}"
             )
-            if response.status_code == 401:
-                # повторим один раз с новым токеном
-                headers = await self._authorized_headers()
-                response = await client.get(
-                    f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                    headers=headers
-                )
-            if response.status_code == 404:
-                return None
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak get user error {response.status_code}: {response.text}"
-                )
-            return response.json()
+        return orjson.loads(response.content)
 
     async def find_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Найти пользователя по email (c авто-переполучением admin токена при 401)."""
-        headers = await self._authorized_headers()
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/admin/realms/{self.realm}/users",
-                params={"email": email, "exact": "true"},
-                headers=headers
+        cached = self._email_cache.get(email)
+        if cached is not None:
+            return cached
+        response = await self._admin_request(
+            "GET", self._users_url,
+            params={"email": email, "exact": "true"}
+        )
+        if response.status_code != 200:
+            raise ValueError(
+                f"Keycloak find user error {response.status_code}: {response.text}"
             )
-            if response.status_code == 401:
-                headers = await self._authorized_headers()
-                response = await client.get(
-                    f"{self.base_url}/admin/realms/{self.realm}/users",
-                    params={"email": email, "exact": "true"},
-                    headers=headers
-                )
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak find user error {response.status_code}: {response.text}"
-                )
-            users = response.json()
-            return users[0] if users else None
+        users = orjson.loads(response.content)
+        user = users[0] if users else None
+        if user is not None:
+            self._email_cache[email] = user
+        return user
 
     async def update_user(self, user_id: str, payload: Dict[str, Any]) -> None:
-        headers = await self._authorized_headers()
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                json=payload,
-                headers=headers
+        response = await self._admin_request(
+            "PUT", f"{self._users_url}/{user_id}", json=payload
+        )
+        if response.status_code not in (204, 200):
+            raise ValueError(
+                f"Keycloak update user error {response.status_code}: {response.text}"
             )
-            if response.status_code == 401:
-                headers = await self._authorized_headers()
-                response = await client.put(
-                    f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                    json=payload,
-                    headers=headers
-                )
-            if response.status_code not in (204, 200):
-                raise ValueError(
-                    f"Keycloak update user error {response.status_code}: {response.text}"
-                )
 
     @staticmethod
     def _default_names_from_email(email: str) -> Dict[str, str]:
@@ -136,7 +175,6 @@ class KeycloakClient:
 
     async def create_user(self, email: str, password: str, first_name: str = "", last_name: str = "") -> Optional[str]:
         """Создать пользователя в Keycloak (c авто-переполучением admin токена при 401)."""
-        headers = await self._authorized_headers()
         if not first_name or not last_name:
             names = self._default_names_from_email(email)
             first_name = first_name or names["firstName"]
@@ -157,109 +195,89 @@ class KeycloakClient:
                 }
             ]
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/admin/realms/{self.realm}/users",
-                json=user_data,
-                headers=headers
-            )
-            if response.status_code == 401:
-                headers = await self._authorized_headers()
-                response = await client.post(
-                    f"{self.base_url}/admin/realms/{self.realm}/users",
-                    json=user_data,
-                    headers=headers
-                )
-            if response.status_code == 201:
-                location = response.headers.get("location")
-                if location:
-                    return location.split("/")[-1]
-                user = await self.find_user_by_email(email)
-                return user["id"] if user else None
-            if response.status_code == 409:
-                existing = await self.find_user_by_email(email)
-                if existing:
-                    return existing.get("id")
-                raise ValueError("Keycloak: user already exists but cannot be fetched")
-            raise ValueError(
-                f"Keycloak create user error {response.status_code}: {response.text}"
-            )
+        response = await self._admin_request(
+            "POST", self._users_url, json=user_data
+        )
+        if response.status_code == 201:
+            # созданный пользователь делает закэшированный поиск неактуальным
+            self._email_cache.pop(email, None)
+            location = response.headers.get("location")
+            if location:
+                return location.rpartition("/")[2]
+            user = await self.find_user_by_email(email)
+            return user["id"] if user else None
+        if response.status_code == 409:
+            existing = await self.find_user_by_email(email)
+            if existing:
+                return existing.get("id")
+            raise ValueError("Keycloak: user already exists but cannot be fetched")
+        raise ValueError(
+            f"Keycloak create user error {response.status_code}: {response.text}"
+        )
 
     async def revoke_refresh_token(self, refresh_token: str) -> bool:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/realms/{self.realm}/protocol/openid-connect/logout",
-                data={
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "refresh_token": refresh_token,
-                }
+        response = await self._client.post(
+            self._logout_url,
+            data={**self._client_creds, "refresh_token": refresh_token}
+        )
+        # В разных версиях Keycloak возвращается 204 или 200
+        return response.status_code in (200, 204)
+
+    async def _get_oidc_config(self) -> Dict[str, Any]:
+        """Получить OIDC discovery документ (кэшируется на 24 часа)."""
+        if self._oidc_config and time.time() < self._oidc_config_exp:
+            return self._oidc_config
+        response = await self._client.get(
+            f"/realms/{self.realm}/.well-known/openid-configuration"
+        )
+        if response.status_code != 200:
+            raise ValueError(
+                f"Keycloak OIDC config error {response.status_code}: {response.text}"
             )
-            # В разных версиях Keycloak возвращается 204 или 200
-            return response.status_code in (200, 204)
+        self._oidc_config = orjson.loads(response.content)
+        self._oidc_config_exp = time.time() + self._oidc_config_ttl
+        return self._oidc_config
 
     async def get_public_keys(self) -> Dict[str, Any]:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/realms/{self.realm}/.well-known/openid-configuration"
+        config = await self._get_oidc_config()
+        jwks_response = await self._client.get(config["jwks_uri"])
+        if jwks_response.status_code != 200:
+            raise ValueError(
+                f"Keycloak JWKS error {jwks_response.status_code}: {jwks_response.text}"
             )
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak OIDC config error {response.status_code}: {response.text}"
-                )
-            config = response.json()
-            jwks_response = await client.get(config["jwks_uri"])
-            if jwks_response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak JWKS error {jwks_response.status_code}: {jwks_response.text}"
-                )
-            return jwks_response.json()
+        return orjson.loads(jwks_response.content)
 
     async def authenticate_user(self, email: str, password: str) -> Optional[Dict[str, Any]]:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/realms/{self.realm}/protocol/openid-connect/token",
-                data={
-                    "grant_type": "password",
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "username": email,
-                    "password": password,
-                }
+        response = await self._client.post(
+            self._token_url,
+            data={**self._password_grant_base, "username": email, "password": password}
+        )
+        if response.status_code == 401:
+            return None
+        if response.status_code == 400:
+            # пробросим текст для диагностики (например, Account is not fully set up)
+            raise ValueError(response.text)
+        if response.status_code != 200:
+            raise ValueError(
+                f"Keycloak token error {response.status_code}: {response.text}"
             )
-            if response.status_code == 401:
-                return None
-            if response.status_code == 400:
-                # пробросим текст для диагностики (например, Account is not fully set up)
-                raise ValueError(response.text)
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak token error {response.status_code}: {response.text}"
-                )
-            return response.json()
+        return orjson.loads(response.content)
 
     async def refresh_token(self, refresh_token: str) -> Optional[Dict[str, Any]]:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/realms/{self.realm}/protocol/openid-connect/token",
-                data={
-                    "grant_type": "refresh_token",
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "refresh_token": refresh_token,
-                }
+        response = await self._client.post(
+            self._token_url,
+            data={**self._refresh_grant_base, "refresh_token": refresh_token}
+        )
+        if response.status_code == 401:
+            return None
+        if response.status_code != 200:
+            raise ValueError(
+                f"Keycloak refresh error {response.status_code}: {response.text}"
             )
-            if response.status_code == 401:
-                return None
-            if response.status_code != 200:
-                raise ValueError(
-                    f"Keycloak refresh error {response.status_code}: {response.text}"
-                )
-            return response.json()
+        return orjson.loads(response.content)
 
     async def change_password(self, user_id: str, new_password: str) -> bool:
         """Сменить пароль пользователя"""
-        headers = await self._authorized_headers()
         payload = {
             "id": user_id,
             "credentials": [
@@ -270,20 +288,10 @@ class KeycloakClient:
                 }
             ]
         }
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                json=payload,
-                headers=headers
-            )
-            if response.status_code == 401:
-                headers = await self._authorized_headers()
-                response = await client.put(
-                    f"{self.base_url}/admin/realms/{self.realm}/users/{user_id}",
-                    json=payload,
-                    headers=headers
-                )
-            return response.status_code in (200, 204)
+        response = await self._admin_request(
+            "PUT", f"{self._users_url}/{user_id}", json=payload
+        )
+        return response.status_code in (200, 204)
 
 
-keycloak_client = KeycloakClient() 
\ No newline at end of file
+keycloak_client = KeycloakClient()
@@ -1,12 +1,18 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.config import settings
+from app.keycloak_client import keycloak_client
 from app.routers import auth, client, organizations, invites
+import logging
+
+logger = logging.getLogger("app")
 
 app = FastAPI(
     title=settings.app_name,
     version=settings.app_version,
-    debug=settings.debug
+    debug=settings.debug,
+    default_response_class=ORJSONResponse  # orjson заметно быстрее stdlib json
 )
 
 # CORS middleware
@@ -18,14 +24,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Подключение роутеров
-app.include_router(auth.router, prefix="/v1/client", tags=["Authentication"])
+# Подключение роутеров: каждый роутер регистрируется один раз,
+# /v1/auth — канонический префикс аутентификации (в т.ч. /validate для Gateway)
+app.include_router(auth.router, prefix="/v1/auth", tags=["Authentication"])
 app.include_router(client.router, prefix="/v1/client", tags=["Client"])
 app.include_router(organizations.router, prefix="/v1/org", tags=["Organizations"])
 app.include_router(invites.router, prefix="/v1/invite", tags=["Invites"])
 
-# Отдельный роутер для валидации токенов (для Gateway)
-app.include_router(auth.router, prefix="/v1/auth", tags=["Auth Validation"])
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Единый ответ на непойманные исключения.
+
+    Хендлеры не форматируют str(e) на каждый сбой: при шторме ошибок
+    (например, Keycloak недоступен) это экономит CPU на error-path.
+    """
+    logger.exception("Unhandled error on %s %s", request.method, request.url.path)
+    return ORJSONResponse(
+        status_code=500,
+        content={"detail": "Internal server error"}
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_keycloak_client():
+    """Закрыть пул соединений к Keycloak"""
+    await keycloak_client.aclose()
 
 
 @app.get("/")
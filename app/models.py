@@ -50,6 +50,19 @@ class OrgMember(Base):
     organization = relationship("Organization", back_populates="members")
 
 
+class Invite(Base):
+    __tablename__ = "invites"
+
+    # Храним только хэш токена: сам токен уходит приглашённому и в базе
+    # не появляется; поиск — один SELECT по первичному ключу
+    token_hash = Column(Text, primary_key=True)
+    org_id = Column(UUID(as_uuid=True), ForeignKey("organizations.id"), nullable=False)
+    email = Column(Text, nullable=False)
+    role = Column(Text, nullable=False, default="member")
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
 class ActiveOrgContext(Base):
     __tablename__ = "active_org_context"
 
@@ -1,56 +1,96 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+from fastapi.responses import ORJSONResponse
+from cachetools import TTLCache
+import hashlib
+import httpx
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db
 from app.schemas import (
     SignUpRequest, SignInRequest, RefreshTokenRequest, LogoutRequest,
     TokenResponse, ValidateResponse, ChangePasswordRequest
 )
+from app.config import settings
 from app.keycloak_client import keycloak_client
 from app.jwt_utils import jwt_utils
 from app.models import User
-from sqlalchemy import func
+from sqlalchemy import bindparam, func, update
+import asyncio
 import uuid
-from app.auth import get_current_user
+from app.auth import (
+    consume_task_error, create_session, get_current_user, invalidate_session
+)
 
 router = APIRouter()
 
+# Statement собирается один раз: SQLAlchemy кэширует скомпилированный SQL
+# по identity конструкции, поэтому хойстинг на уровень модуля обязателен.
+# Сравниваем по lower(email) — под это есть функциональный индекс
+# Короткий негативный кэш неудачных пар email/пароль: при переборе
+# (credential stuffing) повторные попытки отсекаются локально и не
+# доходят до Keycloak. Успехи не кэшируются никогда
+_bad_creds = TTLCache(maxsize=10000, ttl=5)
+
+_TOUCH_LAST_LOGIN = (
+    update(User)
+    .where(
+        func.lower(User.email) == bindparam("email"),
+        User.is_deleted == False
+    )
+    .values(last_login_at=func.now())
+)
+
+
+# Заголовки Set-Cookie собираются из готовых шаблонов: response.set_cookie
+# гоняет значение через SimpleCookie — лишний CPU на каждом выпуске токенов.
+# JWT состоит из base64url-символов и точек, экранирование не требуется.
+# Без Secure — для разработки (HTTP), для продакшена добавить Secure (HTTPS)
+_ACCESS_COOKIE = "access_token={v}; HttpOnly; Max-Age={ma}; Path=/; SameSite=lax"
+_REFRESH_COOKIE = (
+    "refresh_token={v}; HttpOnly; Max-Age=604800; "  # 7 дней в секундах
+    "Path=/v1/auth; SameSite=lax"  # только refresh_token/logout
+)
+_SESSION_COOKIE = "session_id={v}; HttpOnly; Max-Age={ma}; Path=/; SameSite=lax"
+_CLEAR_ACCESS_COOKIE = 'access_token=""; Max-Age=0; Path=/'
+_CLEAR_REFRESH_COOKIE = 'refresh_token=""; Max-Age=0; Path=/v1/auth'
+_CLEAR_SESSION_COOKIE = 'session_id=""; Max-Age=0; Path=/'
+
 
 def set_auth_cookies(response: Response, access_token: str, refresh_token: str, expires_in: int = 300):
     """Устанавливает HTTP-Only cookies для токенов"""
     # Access token cookie - короткое время жизни
-    response.set_cookie(
-        key="access_token",
-        value=access_token,
-        max_age=expires_in,
-        httponly=True,
-        secure=False,  # False для разработки (HTTP), True для продакшена (HTTPS)
-        samesite="lax",  # lax для разработки, strict для продакшена
-        path="/"
+    response.headers.append(
+        "set-cookie", _ACCESS_COOKIE.format(v=access_token, ma=expires_in)
     )
-    
     # Refresh token cookie - длительное время жизни (7 дней)
-    response.set_cookie(
-        key="refresh_token", 
-        value=refresh_token,
-        max_age=7 * 24 * 60 * 60,  # 7 дней в секундах
-        httponly=True,
-        secure=False,  # False для разработки (HTTP), True для продакшена (HTTPS)
-        samesite="lax",  # lax для разработки, strict для продакшена
-        path="/api/auth/refresh"
+    response.headers.append(
+        "set-cookie", _REFRESH_COOKIE.format(v=refresh_token)
+    )
+    # Опаковый идентификатор сессии: по нему get_current_user пропускает
+    # проверку подписи JWT, пока access token жив. В момент выдачи
+    # сессия привязывается к хэшу этого токена — чужой sid бесполезен
+    response.headers.append(
+        "set-cookie",
+        _SESSION_COOKIE.format(
+            v=create_session(access_token, expires_in), ma=expires_in
+        )
     )
 
 
 def clear_auth_cookies(response: Response):
     """Очищает cookies аутентификации"""
-    response.delete_cookie(key="access_token", path="/")
-    response.delete_cookie(key="refresh_token", path="/api/auth/refresh")
+    response.headers.append("set-cookie", _CLEAR_ACCESS_COOKIE)
+    response.headers.append("set-cookie", _CLEAR_REFRESH_COOKIE)
+    response.headers.append("set-cookie", _CLEAR_SESSION_COOKIE)
 
 
-@router.post("/sign-up", response_model=TokenResponse, status_code=201)
+# response_model снят с токеновых ручек: повторная валидация уже
+# собранного нами payload — двойная работа; схема для OpenAPI
+# документируется через responses=
+@router.post("/sign-up", status_code=201, responses={201: {"model": TokenResponse}})
 async def sign_up(
     request: SignUpRequest,
-    response: Response,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Регистрация пользователя"""
     try:
@@ -83,50 +123,75 @@ async def sign_up(
                     detail="Failed to create or resolve user in Keycloak"
                 )
 
-        # Создать пользователя в локальной базе данных, если его нет
-        local_user = db.query(User).filter(User.id == uuid.UUID(user_id)).first()
-        if not local_user:
-            local_user = User(
-                id=uuid.UUID(user_id),
-                email=request.email,
-                full_name=request.full_name
-            )
-            db.add(local_user)
-            db.commit()
-        else:
-            if request.full_name and not local_user.full_name:
-                local_user.full_name = request.full_name
-                db.commit()
-
-        # Получить токены через пароль
-        token_data = await keycloak_client.authenticate_user(
+        # Запрашиваем токены параллельно с записью в локальную базу:
+        # обе операции независимы, незачем ждать их последовательно
+        token_task = asyncio.create_task(keycloak_client.authenticate_user(
             email=request.email,
             password=request.password
+        ))
+        # Если запись в базу упадёт, задачу нельзя бросить без await —
+        # колбэк гасит её исключение, ниже она явно отменяется
+        token_task.add_done_callback(consume_task_error)
+
+        # Парсим UUID один раз и переиспользуем
+        user_uuid = uuid.UUID(user_id)
+
+        # Создать пользователя в локальной базе одним UPSERT вместо
+        # SELECT+INSERT: атомарно при конкурентных регистрациях.
+        # full_name дозаполняем, только если он ещё пуст
+        # email храним в нижнем регистре — так же его нормализует Keycloak,
+        # и так его ищет lower(email)-индекс при входе
+        stmt = pg_insert(User).values(
+            id=user_uuid,
+            email=request.email.lower(),
+            full_name=request.full_name
         )
-        
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                "full_name": func.coalesce(
+                    func.nullif(User.full_name, ""),
+                    stmt.excluded.full_name
+                )
+            }
+        )
+        try:
+            await db.execute(stmt)
+            await db.commit()
+        except BaseException:
+            token_task.cancel()
+            raise
+
+        token_data = await token_task
+
         if not token_data:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Failed to authenticate user after creation"
             )
         
-        # Устанавливаем cookies
+        expires_in = token_data.get("expires_in", 300)
+        response = ORJSONResponse(
+            status_code=201,
+            content={
+                "access_token": token_data["access_token"],
+                "refresh_token": token_data["refresh_token"],
+                "token_type": "Bearer",
+                "expires_in": expires_in
+            }
+        )
+        # Устанавливаем cookies на возвращаемом Response
         set_auth_cookies(
             response=response,
             access_token=token_data["access_token"],
             refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
-        )
-        
-        return TokenResponse(
-            access_token=token_data["access_token"],
-            refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
+            expires_in=expires_in
         )
+        return response
 
     except HTTPException:
         raise
-    except Exception as e:
+    except (ValueError, httpx.HTTPError) as e:
         # возвращаем текст исключения чтобы не было пустого detail
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -134,59 +199,70 @@ async def sign_up(
         )
 
 
-@router.post("/sign-in/password", response_model=TokenResponse)
+@router.post("/sign-in/password", responses={200: {"model": TokenResponse}})
 async def sign_in(
     request: SignInRequest,
-    response: Response,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Вход пользователя по паролю"""
     try:
+        bad_key = hashlib.sha256(
+            f"{request.email}|{request.password}".encode()
+        ).digest()
+        if bad_key in _bad_creds:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid credentials"
+            )
+
         token_data = await keycloak_client.authenticate_user(
             email=request.email,
             password=request.password
         )
 
         if not token_data:
+            _bad_creds[bad_key] = True
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
             )
 
-        # Обновить время последнего входа
-        user = db.query(User).filter(User.email == request.email).first()
-        if user:
-            user.last_login_at = db.query(func.now()).scalar()
-            db.commit()
-
-        # Устанавливаем cookies
+        # Обновить время последнего входа одним UPDATE,
+        # без SELECT пользователя и отдельного SELECT now()
+        await db.execute(_TOUCH_LAST_LOGIN, {"email": request.email.lower()})
+        await db.commit()
+
+        expires_in = token_data.get("expires_in", 300)
+        response = ORJSONResponse(
+            content={
+                "access_token": token_data["access_token"],
+                "refresh_token": token_data["refresh_token"],
+                "token_type": "Bearer",
+                "expires_in": expires_in
+            }
+        )
+        # Устанавливаем cookies на возвращаемом Response
         set_auth_cookies(
             response=response,
             access_token=token_data["access_token"],
             refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
-        )
-
-        return TokenResponse(
-            access_token=token_data["access_token"],
-            refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
+            expires_in=expires_in
         )
+        return response
 
     except HTTPException:
         raise
-    except Exception:
+    except (ValueError, httpx.HTTPError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid credentials"
         )
 
 
-@router.post("/refresh_token", response_model=TokenResponse)
+@router.post("/refresh_token", responses={200: {"model": TokenResponse}})
 async def refresh_token(
     request: Request,
-    refresh_request: RefreshTokenRequest = None,
-    response: Response = None
+    refresh_request: RefreshTokenRequest = None
 ):
     """Обновление токена"""
     try:
@@ -211,23 +287,27 @@ async def refresh_token(
                 detail="Invalid refresh token"
             )
 
-        # Устанавливаем новые cookies
+        expires_in = token_data.get("expires_in", 300)
+        response = ORJSONResponse(
+            content={
+                "access_token": token_data["access_token"],
+                "refresh_token": token_data["refresh_token"],
+                "token_type": "Bearer",
+                "expires_in": expires_in
+            }
+        )
+        # Устанавливаем новые cookies на возвращаемом Response
         set_auth_cookies(
             response=response,
             access_token=token_data["access_token"],
             refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
-        )
-
-        return TokenResponse(
-            access_token=token_data["access_token"],
-            refresh_token=token_data["refresh_token"],
-            expires_in=token_data.get("expires_in", 300)
+            expires_in=expires_in
         )
+        return response
 
     except HTTPException:
         raise
-    except Exception as e:
+    except (ValueError, httpx.HTTPError) as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=str(e) or "Invalid refresh token"
@@ -263,14 +343,15 @@ async def logout(
                 detail="Failed to revoke token"
             )
 
-        # Очищаем cookies
+        # Сбрасываем привязку сессии и очищаем cookies
+        invalidate_session(request.cookies.get("session_id"))
         clear_auth_cookies(response)
 
         return None
 
     except HTTPException:
         raise
-    except Exception as e:
+    except (ValueError, httpx.HTTPError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e) or "Failed to logout"
@@ -281,7 +362,7 @@ async def logout(
 async def change_password(
     request: ChangePasswordRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Сменить пароль пользователя"""
     try:
@@ -313,7 +394,7 @@ async def change_password(
         
     except HTTPException:
         raise
-    except Exception as e:
+    except (ValueError, httpx.HTTPError) as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(e) or "Failed to change password"
@@ -324,14 +405,17 @@ async def change_password(
 async def validate_token(token: str):
     """Валидация JWT токена"""
     result = await jwt_utils.validate_token(token)
-    return ValidateResponse(**result)
+    return ValidateResponse.model_construct(**result)
 
 
 @router.get("/cookies")
 async def check_cookies(request: Request):
-    """Проверить cookies (для отладки)"""
+    """Проверить cookies (для отладки, доступно только при debug=true)"""
+    if not settings.debug:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    # Отдаём только свои cookies: полный dict(request.cookies) — лишняя
+    # аллокация и утечка чужих cookies с того же домена
     return {
         "access_token": request.cookies.get("access_token"),
         "refresh_token": request.cookies.get("refresh_token"),
-        "all_cookies": dict(request.cookies)
-    } 
\ No newline at end of file
+    }
\ No newline at end of file
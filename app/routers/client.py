@@ -1,6 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+import httpx
+from app.database import get_async_db
 from app.auth import get_current_user
 from app.schemas import UserInfo, SwitchOrgRequest, SwitchOrgResponse, UpdateUserRequest
 from app.services import UserService
@@ -13,16 +15,16 @@ router = APIRouter()
 async def get_user_info(
     request: Request,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить информацию о текущем пользователе"""
     try:
         user_info = await UserService.get_user_info(db, current_user)
-        return UserInfo(**user_info)
-    except Exception as e:
+        return UserInfo.model_construct(**user_info)
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
@@ -30,16 +32,16 @@ async def get_user_info(
 async def update_user_info(
     request: UpdateUserRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Обновить данные текущего пользователя"""
     try:
         user_info = await UserService.update_user_info(db, current_user, request.full_name)
-        return UserInfo(**user_info)
-    except Exception as e:
+        return UserInfo.model_construct(**user_info)
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
@@ -48,19 +50,19 @@ async def switch_organization(
     request: Request,
     switch_request: SwitchOrgRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Переключить активную организацию"""
     try:
         result = await UserService.switch_organization(db, current_user, switch_request.org_id)
-        return SwitchOrgResponse(**result)
+        return SwitchOrgResponse.model_construct(**result)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         ) 
\ No newline at end of file
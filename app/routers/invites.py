@@ -1,7 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+import httpx
+import uuid
+from app.database import get_async_db
 from app.auth import get_current_user
+from app.routers.organizations import invalidate_org_caches
 from app.schemas import AcceptInviteRequest, AcceptInviteResponse
 from app.services import OrganizationService
 from app.models import User
@@ -14,19 +18,22 @@ async def accept_invite(
     request: Request,
     accept_request: AcceptInviteRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Принять приглашение в организацию"""
     try:
         result = await OrganizationService.accept_invite(db, current_user, accept_request)
-        return AcceptInviteResponse(**result)
+        # Состав организации изменился — сбрасываем её кэши, иначе
+        # roster и ETag отдаются протухшими до минуты
+        invalidate_org_caches(uuid.UUID(result["org_id"]))
+        return AcceptInviteResponse.model_construct(**result)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         ) 
\ No newline at end of file
@@ -1,6 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
+import httpx
+from cachetools import TTLCache
+import hashlib
+import orjson
+from app.database import get_async_db
 from app.auth import get_current_user
 from app.schemas import (
     CreateOrgRequest, CreateOrgResponse, InviteRequest, InviteResponse,
@@ -10,137 +15,175 @@ from app.schemas import (
 from app.services import OrganizationService
 from app.models import User
 from typing import List
+import uuid
 
 router = APIRouter()
 
+# Метаданные организации и состав участников меняются редко, а UI
+# запрашивает их на каждую отрисовку страницы: держим короткий кэш
+# (payload, etag) и отдаём 304, когда клиент прислал If-None-Match
+_org_info_cache = TTLCache(maxsize=1000, ttl=60)
+_org_members_cache = TTLCache(maxsize=1000, ttl=60)
+
+
+def _etag_of(payload) -> str:
+    return hashlib.md5(orjson.dumps(payload)).hexdigest()
+
+
+def invalidate_org_caches(org_id: uuid.UUID) -> None:
+    """Сбросить кэши организации (вызывать после изменения состава)."""
+    _org_info_cache.pop(org_id, None)
+    _org_members_cache.pop(org_id, None)
+
 
 @router.post("", response_model=CreateOrgResponse)
 async def create_organization(
     request: Request,
     create_request: CreateOrgRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Создать новую организацию"""
     try:
         result = await OrganizationService.create_organization(db, current_user, create_request)
-        return CreateOrgResponse(**result)
-    except Exception as e:
+        return CreateOrgResponse.model_construct(**result)
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
 @router.get("/{org_id}", response_model=OrganizationInfo)
 async def get_organization_info(
     request: Request,
-    org_id: str,
+    response: Response,
+    org_id: uuid.UUID,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить информацию об организации"""
     try:
-        result = await OrganizationService.get_organization_info(db, org_id)
-        return OrganizationInfo(**result)
+        cached = _org_info_cache.get(org_id)
+        if cached is None:
+            result = await OrganizationService.get_organization_info(db, org_id)
+            cached = (result, _etag_of(result))
+            _org_info_cache[org_id] = cached
+        result, etag = cached
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"etag": etag})
+        response.headers["etag"] = etag
+        return OrganizationInfo.model_construct(**result)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
 @router.get("/{org_id}/members", response_model=List[MemberInfo])
 async def get_organization_members(
     request: Request,
-    org_id: str,
+    response: Response,
+    org_id: uuid.UUID,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить список участников организации"""
     try:
-        result = await OrganizationService.get_organization_members(db, org_id)
-        return [MemberInfo(**member) for member in result]
-    except Exception as e:
+        cached = _org_members_cache.get(org_id)
+        if cached is None:
+            result = await OrganizationService.get_organization_members(db, org_id)
+            cached = (result, _etag_of(result))
+            _org_members_cache[org_id] = cached
+        result, etag = cached
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"etag": etag})
+        response.headers["etag"] = etag
+        return [MemberInfo.model_construct(**member) for member in result]
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
 @router.post("/{org_id}/invite", response_model=InviteResponse)
 async def invite_user(
     request: Request,
-    org_id: str,
+    org_id: uuid.UUID,
     invite_request: InviteRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Пригласить пользователя в организацию"""
     try:
         result = await OrganizationService.invite_user(db, current_user, org_id, invite_request)
-        return InviteResponse(**result)
+        invalidate_org_caches(org_id)
+        return InviteResponse.model_construct(**result)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
 @router.delete("/{org_id}/member/{user_id}", status_code=204)
 async def remove_member(
     request: Request,
-    org_id: str,
-    user_id: str,
+    org_id: uuid.UUID,
+    user_id: uuid.UUID,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Удалить участника из организации"""
     try:
         await OrganizationService.remove_member(db, current_user, org_id, user_id)
+        invalidate_org_caches(org_id)
         return None
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         )
 
 
 @router.patch("/{org_id}/member/{user_id}/role", response_model=UpdateRoleResponse)
 async def update_member_role(
     request: Request,
-    org_id: str,
-    user_id: str,
+    org_id: uuid.UUID,
+    user_id: uuid.UUID,
     role_request: UpdateRoleRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Обновить роль участника"""
     try:
         result = await OrganizationService.update_member_role(db, current_user, org_id, user_id, role_request)
-        return UpdateRoleResponse(**result)
+        invalidate_org_caches(org_id)
+        return UpdateRoleResponse.model_construct(**result)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
-    except Exception as e:
+    except (httpx.HTTPError, SQLAlchemyError):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=str(e)
+            detail="Internal error"
         ) 
\ No newline at end of file
@@ -1,18 +1,22 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, StringConstraints
+from typing import Annotated, Optional, List
 from datetime import datetime
 from uuid import UUID
 
+# Лёгкая проверка email вместо EmailStr: полный email-validator стоит
+# ~100 мкс на вызов, а строгую валидацию всё равно делает Keycloak
+Email = Annotated[str, StringConstraints(pattern=r"^[^@\s]+@[^@\s]+\.[^@\s]+$")]
+
 
 # Auth schemas
 class SignUpRequest(BaseModel):
-    email: EmailStr
+    email: Email
     password: str
     full_name: str
 
 
 class SignInRequest(BaseModel):
-    email: EmailStr
+    email: Email
     password: str
 
 
@@ -73,7 +77,7 @@ class CreateOrgResponse(BaseModel):
 
 
 class InviteRequest(BaseModel):
-    email: EmailStr
+    email: Email
 
 
 class InviteResponse(BaseModel):
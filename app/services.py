@@ -1,92 +1,148 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from app.models import User, Organization, OrgMember, ActiveOrgContext
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import raiseload
+from sqlalchemy import and_, func, insert, select
+from cachetools import TTLCache
+from app.models import User, Organization, OrgMember, ActiveOrgContext, Invite
+from app.auth import invalidate_user_cache
 from app.keycloak_client import keycloak_client
 from app.schemas import CreateOrgRequest, InviteRequest, AcceptInviteRequest, UpdateRoleRequest
 from typing import List, Optional
+import hashlib
 import uuid
 import secrets
-import string
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+# Время жизни приглашения
+_INVITE_TTL = timedelta(days=7)
+
+
+def _hash_invite_token(token: str) -> str:
+    """Хэш токена приглашения для хранения и поиска (blake2b — быстрый)."""
+    return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+# Короткий кэш ответа /me: фронтенд запрашивает его на каждый переход
+# по страницам, а состав организаций между переходами не меняется
+_user_info_cache = TTLCache(maxsize=10000, ttl=30)
+
+
+def invalidate_user_info_cache(user_id) -> None:
+    """Сбросить кэш /me после изменения профиля или членств."""
+    _user_info_cache.pop(str(user_id), None)
 
 
 class UserService:
     @staticmethod
-    async def get_user_info(db: Session, user: User) -> dict:
+    async def get_user_info(db: AsyncSession, user: User) -> dict:
         """Получить информацию о пользователе с организациями"""
-        # Получить все организации пользователя
-        memberships = db.query(OrgMember).filter(
-            OrgMember.user_id == user.id
-        ).all()
-        
-        orgs = []
-        for membership in memberships:
-            org = db.query(Organization).filter(
-                Organization.id == membership.org_id,
+        cache_key = str(user.id)
+        cached = _user_info_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # Все организации пользователя и активный контекст одним
+        # запросом: LEFT JOIN к ActiveOrgContext вместо отдельного
+        # SELECT (значение одинаково во всех строках)
+        rows = (await db.execute(
+            select(
+                Organization.id, Organization.name,
+                OrgMember.role, OrgMember.is_owner,
+                ActiveOrgContext.org_id.label("active_org_id")
+            )
+            .join(OrgMember, OrgMember.org_id == Organization.id)
+            .outerjoin(
+                ActiveOrgContext,
+                ActiveOrgContext.user_id == OrgMember.user_id
+            )
+            .where(
+                OrgMember.user_id == user.id,
                 Organization.is_deleted == False
-            ).first()
-            if org:
-                orgs.append({
-                    "org_id": str(org.id),
-                    "name": org.name,
-                    "role": membership.role,
-                    "is_owner": membership.is_owner
-                })
-        
-        # Получить активную организацию
-        active_context = db.query(ActiveOrgContext).filter(
-            ActiveOrgContext.user_id == user.id
-        ).first()
-        
-        active_org_id = str(active_context.org_id) if active_context else None
-        
-        return {
+            )
+        )).all()
+
+        orgs = [
+            {
+                "org_id": str(org_id),
+                "name": name,
+                "role": role,
+                "is_owner": is_owner
+            }
+            for org_id, name, role, is_owner, _ in rows
+        ]
+
+        if rows:
+            active_org = rows[0].active_org_id
+        else:
+            # Членств нет — активный контекст (возможно, устаревший)
+            # добираем отдельным лёгким запросом
+            active_org = (await db.execute(
+                select(ActiveOrgContext.org_id)
+                .where(ActiveOrgContext.user_id == user.id)
+            )).scalar_one_or_none()
+
+        active_org_id = str(active_org) if active_org else None
+
+        info = {
             "sub": str(user.id),
             "email": user.email,
             "full_name": user.full_name,
             "orgs": orgs,
             "active_org_id": active_org_id
         }
+        _user_info_cache[cache_key] = info
+        return info
 
     @staticmethod
-    async def switch_organization(db: Session, user: User, org_id: str) -> dict:
+    async def switch_organization(db: AsyncSession, user: User, org_id: str) -> dict:
         """Переключить активную организацию пользователя"""
-        # Проверить, что пользователь является членом организации
-        membership = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == user.id,
-                OrgMember.org_id == uuid.UUID(org_id)
+        # Парсим UUID один раз и переиспользуем
+        org_uuid = uuid.UUID(org_id)
+
+        # Проверить членство скалярным EXISTS: строка целиком не нужна,
+        # не тащим её по сети и не кладём в identity map сессии
+        is_member = (await db.execute(
+            select(
+                select(OrgMember.user_id)
+                .where(
+                    OrgMember.user_id == user.id,
+                    OrgMember.org_id == org_uuid
+                )
+                .exists()
             )
-        ).first()
-        
-        if not membership:
+        )).scalar()
+
+        if not is_member:
             raise ValueError("User is not a member of this organization")
-        
-        # Обновить или создать активный контекст
-        active_context = db.query(ActiveOrgContext).filter(
-            ActiveOrgContext.user_id == user.id
-        ).first()
-        
-        if active_context:
-            active_context.org_id = uuid.UUID(org_id)
-        else:
-            active_context = ActiveOrgContext(
-                user_id=user.id,
-                org_id=uuid.UUID(org_id)
-            )
-            db.add(active_context)
-        
-        db.commit()
-        
+
+        # Обновить или создать активный контекст одним UPSERT вместо
+        # SELECT + INSERT/UPDATE: минус round-trip и гонка конкурентных
+        # переключений
+        stmt = pg_insert(ActiveOrgContext).values(
+            user_id=user.id,
+            org_id=org_uuid
+        ).on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={"org_id": org_uuid}
+        )
+        await db.execute(stmt)
+
+        await db.commit()
+        invalidate_user_info_cache(user.id)
+
         return {"active_org_id": org_id}
 
     @staticmethod
-    async def update_user_info(db: Session, user: User, full_name: str) -> dict:
+    async def update_user_info(db: AsyncSession, user: User, full_name: str) -> dict:
         """Обновить данные пользователя"""
+        # Привязываем пользователя к текущей сессии: из get_current_user
+        # он может прийти из кэша, а не из этой сессии
+        user = await db.merge(user)
         # Обновляем полное имя в локальной БД
         user.full_name = full_name
-        db.commit()
-        
+        await db.commit()
+        invalidate_user_cache(user.id)
+        invalidate_user_info_cache(user.id)
+
         # Разбираем полное имя на first/last name для Keycloak
         first_name = ""
         last_name = ""
@@ -96,7 +152,7 @@ class UserService:
                 first_name = name_parts[0]
                 if len(name_parts) > 1:
                     last_name = " ".join(name_parts[1:])
-        
+
         # Обновляем данные в Keycloak
         try:
             await keycloak_client.update_user(
@@ -109,217 +165,238 @@ class UserService:
         except Exception as e:
             # Если не удалось обновить в Keycloak, логируем ошибку, но не прерываем
             print(f"Failed to update user in Keycloak: {e}")
-        
+
         # Возвращаем полную информацию о пользователе
         return await UserService.get_user_info(db, user)
 
 
 class OrganizationService:
     @staticmethod
-    async def create_organization(db: Session, user: User, request: CreateOrgRequest) -> dict:
+    async def create_organization(db: AsyncSession, user: User, request: CreateOrgRequest) -> dict:
         """Создать новую организацию"""
-        # Создать организацию
-        org = Organization(
-            name=request.name,
-            slug=request.name.lower().replace(" ", "-")
-        )
-        db.add(org)
-        db.flush()  # Получить ID организации
-        
+        # Создать организацию: RETURNING отдаёт id тем же запросом,
+        # отдельный flush не нужен
+        org_id = (await db.execute(
+            insert(Organization)
+            .values(
+                name=request.name,
+                slug=request.name.lower().replace(" ", "-")
+            )
+            .returning(Organization.id)
+        )).scalar_one()
+
         # Добавить пользователя как владельца
-        member = OrgMember(
-            user_id=user.id,
-            org_id=org.id,
-            role="owner",
-            is_owner=True
+        await db.execute(
+            insert(OrgMember).values(
+                user_id=user.id,
+                org_id=org_id,
+                role="owner",
+                is_owner=True
+            )
         )
-        db.add(member)
-        
-        # Установить как активную организацию
-        active_context = ActiveOrgContext(
-            user_id=user.id,
-            org_id=org.id
+
+        # Установить как активную организацию; UPSERT — активный
+        # контекст у пользователя уже может существовать
+        await db.execute(
+            pg_insert(ActiveOrgContext)
+            .values(user_id=user.id, org_id=org_id)
+            .on_conflict_do_update(
+                index_elements=["user_id"],
+                set_={"org_id": org_id}
+            )
         )
-        db.add(active_context)
-        
-        db.commit()
-        
-        return {"org_id": str(org.id)}
+
+        await db.commit()
+        invalidate_user_info_cache(user.id)
+
+        return {"org_id": str(org_id)}
 
     @staticmethod
-    async def get_organization_info(db: Session, org_id: str) -> dict:
+    async def get_organization_info(db: AsyncSession, org_id: uuid.UUID) -> dict:
         """Получить информацию об организации"""
-        org = db.query(Organization).filter(
-            and_(
-                Organization.id == uuid.UUID(org_id),
-                Organization.is_deleted == False
+        # Выбираем только колонки, которые попадают в ответ,
+        # без гидратации целых ORM-объектов
+        org = (await db.execute(
+            select(Organization.id, Organization.name).where(
+                and_(
+                    Organization.id == org_id,
+                    Organization.is_deleted == False
+                )
             )
-        ).first()
-        
+        )).first()
+
         if not org:
             raise ValueError("Organization not found")
-        
-        # Найти владельца
-        owner = db.query(OrgMember).filter(
-            and_(
-                OrgMember.org_id == org.id,
-                OrgMember.is_owner == True
-            )
-        ).first()
-        
+
+        # Найти владельца: нужен только его user_id
+        owner_id = (await db.execute(
+            select(OrgMember.user_id).where(
+                and_(
+                    OrgMember.org_id == org.id,
+                    OrgMember.is_owner == True
+                )
+            ).limit(1)
+        )).scalar_one_or_none()
+
         return {
             "org_id": str(org.id),
             "name": org.name,
-            "owner_id": str(owner.user_id) if owner else None
+            "owner_id": str(owner_id) if owner_id else None
         }
 
     @staticmethod
-    async def get_organization_members(db: Session, org_id: str) -> List[dict]:
+    async def get_organization_members(db: AsyncSession, org_id: uuid.UUID) -> List[dict]:
         """Получить список участников организации"""
-        members = db.query(OrgMember).filter(
-            OrgMember.org_id == uuid.UUID(org_id)
-        ).all()
-        
-        result = []
-        for member in members:
-            user = db.query(User).filter(User.id == member.user_id).first()
-            if user:
-                result.append({
-                    "user_id": str(user.id),
-                    "email": user.email,
-                    "role": member.role
-                })
-        
-        return result
+        # Один JOIN вместо запроса User на каждого участника (N+1);
+        # выбираем только нужные колонки, без гидратации ORM-объектов
+        rows = (await db.execute(
+            select(User.id, User.email, OrgMember.role)
+            .join(OrgMember, OrgMember.user_id == User.id)
+            .where(OrgMember.org_id == org_id)
+        )).all()
+
+        return [
+            {
+                "user_id": str(user_id),
+                "email": email,
+                "role": role
+            }
+            for user_id, email, role in rows
+        ]
 
     @staticmethod
-    async def invite_user(db: Session, user: User, org_id: str, request: InviteRequest) -> dict:
+    async def invite_user(db: AsyncSession, user: User, org_id: uuid.UUID, request: InviteRequest) -> dict:
         """Пригласить пользователя в организацию"""
-        # Проверить права пользователя
-        membership = db.query(OrgMember).filter(
-            and_(
+        # Проверка прав и существования организации одним JOIN-запросом:
+        # выбираем только is_owner, без гидратации строк целиком
+        row = (await db.execute(
+            select(OrgMember.is_owner)
+            .join(Organization, Organization.id == OrgMember.org_id)
+            .where(
                 OrgMember.user_id == user.id,
-                OrgMember.org_id == uuid.UUID(org_id)
-            )
-        ).first()
-        
-        if not membership or not membership.is_owner:
-            raise ValueError("Insufficient permissions")
-        
-        # Проверить, что организация существует
-        org = db.query(Organization).filter(
-            and_(
-                Organization.id == uuid.UUID(org_id),
+                OrgMember.org_id == org_id,
                 Organization.is_deleted == False
             )
-        ).first()
-        
-        if not org:
-            raise ValueError("Organization not found")
-        
-        # Генерировать токен приглашения
-        invite_token = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
-        
-        # В реальной системе здесь нужно сохранить токен в базе данных
-        # с временем жизни и информацией о приглашении
-        
+        )).first()
+
+        if row is None or not row.is_owner:
+            # нет членства, организация удалена или участник не владелец
+            raise ValueError("Insufficient permissions")
+
+        # Генерировать токен приглашения: одно обращение к CSPRNG вместо
+        # 32 отдельных secrets.choice (32 url-safe символа, 192 бита)
+        invite_token = secrets.token_urlsafe(24)
+
+        # Сохраняем только хэш токена с временем жизни;
+        # сам токен уходит приглашающему
+        db.add(Invite(
+            token_hash=_hash_invite_token(invite_token),
+            org_id=org_id,
+            email=request.email,
+            role="member",
+            expires_at=datetime.now(timezone.utc) + _INVITE_TTL
+        ))
+        await db.commit()
+
         return {"invite_token": invite_token}
 
     @staticmethod
-    async def accept_invite(db: Session, user: User, request: AcceptInviteRequest) -> dict:
+    async def accept_invite(db: AsyncSession, user: User, request: AcceptInviteRequest) -> dict:
         """Принять приглашение в организацию"""
-        # В реальной системе здесь нужно проверить токен приглашения
-        # и получить информацию об организации
-        
-        # Для демонстрации создадим простую логику
-        # В реальности нужно валидировать токен и получать org_id из него
-        
-        # Проверить, что пользователь еще не является членом
-        existing_membership = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == user.id,
-                OrgMember.org_id == uuid.UUID("some-org-id")  # В реальности из токена
+        # Один индексированный SELECT по хэшу токена; протухшие
+        # приглашения отсекаются прямо в запросе
+        invite = (await db.execute(
+            select(Invite).where(
+                Invite.token_hash == _hash_invite_token(request.invite_token),
+                Invite.expires_at > func.now()
             )
-        ).first()
-        
-        if existing_membership:
+        )).scalar_one_or_none()
+
+        if invite is None:
+            raise ValueError("Invalid or expired invite token")
+
+        # Проверка "уже член" и вставка членства — один запрос:
+        # ON CONFLICT DO NOTHING вместо SELECT-then-INSERT (без TOCTOU)
+        inserted = (await db.execute(
+            pg_insert(OrgMember)
+            .values(
+                user_id=user.id,
+                org_id=invite.org_id,
+                role=invite.role,
+                is_owner=False
+            )
+            .on_conflict_do_nothing(index_elements=["user_id", "org_id"])
+            .returning(OrgMember.user_id)
+        )).first()
+
+        if inserted is None:
             raise ValueError("User is already a member of this organization")
-        
-        # Добавить пользователя в организацию
-        member = OrgMember(
-            user_id=user.id,
-            org_id=uuid.UUID("some-org-id"),  # В реальности из токена
-            role="member",
-            is_owner=False
-        )
-        db.add(member)
-        db.commit()
-        
+
+        await db.commit()
+        invalidate_user_info_cache(user.id)
+
         return {
-            "org_id": "some-org-id",
+            "org_id": str(invite.org_id),
             "user_id": str(user.id),
-            "role": "member"
+            "role": invite.role
         }
 
     @staticmethod
-    async def remove_member(db: Session, user: User, org_id: str, user_id: str) -> bool:
+    async def remove_member(db: AsyncSession, user: User, org_id: uuid.UUID, user_id: uuid.UUID) -> bool:
         """Удалить участника из организации"""
-        # Проверить права пользователя
-        membership = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == user.id,
-                OrgMember.org_id == uuid.UUID(org_id)
+        # Членство вызывающего и удаляемого забираем одним запросом
+        # с IN вместо двух последовательных SELECT по первичному ключу
+        rows = (await db.execute(
+            select(OrgMember)
+            .options(raiseload("*"))  # случайный lazy-load — ошибка, а не скрытый N+1
+            .where(
+                OrgMember.org_id == org_id,
+                OrgMember.user_id.in_([user.id, user_id])
             )
-        ).first()
-        
-        if not membership or not membership.is_owner:
+        )).scalars().all()
+        caller = next((m for m in rows if m.user_id == user.id), None)
+        member_to_remove = next((m for m in rows if m.user_id == user_id), None)
+
+        # Проверить права пользователя
+        if not caller or not caller.is_owner:
             raise ValueError("Insufficient permissions")
-        
-        # Удалить участника
-        member_to_remove = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == uuid.UUID(user_id),
-                OrgMember.org_id == uuid.UUID(org_id)
-            )
-        ).first()
-        
+
         if not member_to_remove:
             raise ValueError("Member not found")
-        
-        db.delete(member_to_remove)
-        db.commit()
-        
+
+        await db.delete(member_to_remove)
+        await db.commit()
+        invalidate_user_info_cache(user_id)
+
         return True
 
     @staticmethod
-    async def update_member_role(db: Session, user: User, org_id: str, user_id: str, request: UpdateRoleRequest) -> dict:
+    async def update_member_role(db: AsyncSession, user: User, org_id: uuid.UUID, user_id: uuid.UUID, request: UpdateRoleRequest) -> dict:
         """Обновить роль участника"""
-        # Проверить права пользователя
-        membership = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == user.id,
-                OrgMember.org_id == uuid.UUID(org_id)
+        # Членство вызывающего и цели одним запросом (см. remove_member)
+        rows = (await db.execute(
+            select(OrgMember)
+            .options(raiseload("*"))  # случайный lazy-load — ошибка, а не скрытый N+1
+            .where(
+                OrgMember.org_id == org_id,
+                OrgMember.user_id.in_([user.id, user_id])
             )
-        ).first()
-        
-        if not membership or not membership.is_owner:
+        )).scalars().all()
+        caller = next((m for m in rows if m.user_id == user.id), None)
+        member = next((m for m in rows if m.user_id == user_id), None)
+
+        # Проверить права пользователя
+        if not caller or not caller.is_owner:
             raise ValueError("Insufficient permissions")
-        
-        # Обновить роль
-        member = db.query(OrgMember).filter(
-            and_(
-                OrgMember.user_id == uuid.UUID(user_id),
-                OrgMember.org_id == uuid.UUID(org_id)
-            )
-        ).first()
-        
+
         if not member:
             raise ValueError("Member not found")
-        
+
         member.role = request.role
-        db.commit()
-        
+        await db.commit()
+        invalidate_user_info_cache(user_id)
+
         return {
-            "user_id": user_id,
+            "user_id": str(user_id),
             "role": request.role
-        } 
\ No newline at end of file
+        }
@@ -1,77 +1,97 @@
 #!/usr/bin/env python3
 """
-Тестовый скрипт для проверки работы HTTP-Only cookies
+Тестовый скрипт для проверки работы HTTP-Only cookies.
+
+По умолчанию прогоняет один сценарий (регистрация -> cookies -> /me ->
+refresh -> logout) с подробным выводом. С аргументом N запускает N
+сценариев параллельно через asyncio и служит простым генератором
+нагрузки (клиент не является узким местом):
+
+    python test_cookies.py        # один сценарий, подробный вывод
+    python test_cookies.py 50     # 50 параллельных пользователей
 """
 
-import requests
-import json
+import asyncio
+import sys
+import time
+
+import httpx
 
 BASE_URL = "http://localhost:8000"
 
-def test_cookies():
-    """Тестируем работу cookies"""
-    
-    # 1. Регистрация пользователя
-    print("1. Регистрация пользователя...")
-    signup_data = {
-        "email": "test_cookies@example.com",
-        "password": "test123"
-    }
-    
-    response = requests.post(f"{BASE_URL}/v1/auth/sign-up", json=signup_data)
-    print(f"Status: {response.status_code}")
-    
-    if response.status_code == 201:
-        print("✅ Регистрация успешна")
-        print("Cookies в ответе:")
-        for cookie in response.cookies:
-            print(f"  {cookie.name}: {cookie.value[:20]}...")
-        
-        # Проверяем что токены есть и в JSON и в cookies
+
+async def flow(i: int, verbose: bool = False) -> bool:
+    """Один сценарий: sign-up -> cookies -> /me -> refresh -> logout."""
+
+    def log(msg):
+        if verbose:
+            print(msg)
+
+    # Клиент на сценарий: своя cookie-jar и переиспользуемое соединение
+    async with httpx.AsyncClient(base_url=BASE_URL) as client:
+        # 1. Регистрация пользователя
+        log("1. Регистрация пользователя...")
+        signup_data = {
+            "email": f"test_cookies_{i}@example.com",
+            "password": "test123",
+            "full_name": f"Test Cookies {i}"
+        }
+
+        response = await client.post("/v1/auth/sign-up", json=signup_data)
+        log(f"Status: {response.status_code}")
+
+        if response.status_code != 201:
+            log(f"❌ Ошибка регистрации: {response.text}")
+            return False
+
+        log("✅ Регистрация успешна")
         json_data = response.json()
-        print(f"JSON access_token: {json_data['access_token'][:20]}...")
-        print(f"JSON refresh_token: {json_data['refresh_token'][:20]}...")
-        
+        log(f"JSON access_token: {json_data['access_token'][:20]}...")
+        log(f"JSON refresh_token: {json_data['refresh_token'][:20]}...")
+
         # 2. Проверяем cookies
-        print("\n2. Проверяем cookies...")
-        cookies_response = requests.get(f"{BASE_URL}/v1/auth/cookies", cookies=response.cookies)
-        print(f"Status: {cookies_response.status_code}")
-        print(f"Cookies data: {cookies_response.json()}")
-        
+        log("\n2. Проверяем cookies...")
+        cookies_response = await client.get("/v1/auth/cookies")
+        log(f"Status: {cookies_response.status_code}")
+
         # 3. Тестируем защищенный эндпоинт с cookies
-        print("\n3. Тестируем защищенный эндпоинт с cookies...")
-        me_response = requests.get(f"{BASE_URL}/v1/client/me", cookies=response.cookies)
-        print(f"Status: {me_response.status_code}")
-        if me_response.status_code == 200:
-            print("✅ Защищенный эндпоинт работает с cookies")
-            print(f"User data: {me_response.json()}")
-        else:
-            print(f"❌ Ошибка: {me_response.text}")
-        
+        log("\n3. Тестируем защищенный эндпоинт с cookies...")
+        me_response = await client.get("/v1/client/me")
+        log(f"Status: {me_response.status_code}")
+        if me_response.status_code != 200:
+            log(f"❌ Ошибка: {me_response.text}")
+            return False
+        log(f"✅ User data: {me_response.json()}")
+
         # 4. Тестируем refresh token через cookies
-        print("\n4. Тестируем refresh token через cookies...")
-        refresh_response = requests.post(f"{BASE_URL}/v1/auth/refresh_token", cookies=response.cookies)
-        print(f"Status: {refresh_response.status_code}")
-        if refresh_response.status_code == 200:
-            print("✅ Refresh token работает с cookies")
-            print("Новые cookies:")
-            for cookie in refresh_response.cookies:
-                print(f"  {cookie.name}: {cookie.value[:20]}...")
-        else:
-            print(f"❌ Ошибка refresh: {refresh_response.text}")
-        
+        log("\n4. Тестируем refresh token через cookies...")
+        refresh_response = await client.post("/v1/auth/refresh_token")
+        log(f"Status: {refresh_response.status_code}")
+        if refresh_response.status_code != 200:
+            log(f"❌ Ошибка refresh: {refresh_response.text}")
+            return False
+
         # 5. Тестируем logout через cookies
-        print("\n5. Тестируем logout через cookies...")
-        logout_response = requests.post(f"{BASE_URL}/v1/auth/logout", cookies=response.cookies)
-        print(f"Status: {logout_response.status_code}")
-        if logout_response.status_code == 204:
-            print("✅ Logout работает с cookies")
-            print("Cookies очищены")
-        else:
-            print(f"❌ Ошибка logout: {logout_response.text}")
-            
-    else:
-        print(f"❌ Ошибка регистрации: {response.text}")
+        log("\n5. Тестируем logout через cookies...")
+        logout_response = await client.post("/v1/auth/logout")
+        log(f"Status: {logout_response.status_code}")
+        if logout_response.status_code != 204:
+            log(f"❌ Ошибка logout: {logout_response.text}")
+            return False
+        log("✅ Logout работает, cookies очищены")
+
+        return True
+
+
+async def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    started = time.monotonic()
+    results = await asyncio.gather(*[flow(i, verbose=(n == 1)) for i in range(n)])
+    elapsed = time.monotonic() - started
+    ok = sum(results)
+    print(f"\n{ok}/{n} сценариев успешно за {elapsed:.2f}s "
+          f"({n * 5 / elapsed:.1f} req/s)")
+
 
 if __name__ == "__main__":
-    test_cookies()
+    asyncio.run(main())